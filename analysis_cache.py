@@ -0,0 +1,129 @@
+"""
+This file is responsible for remembering the positions the engine has already analysed, across games and processes.
+The cache lives in a memory-mapped file, so every process that opens the same file shares it and it survives
+between runs.
+"""
+import mmap
+import os
+import struct
+
+MAGIC = b"CHESSAC1"
+HEADER = struct.Struct("<8sIIQ")   # Magic, number of buckets, entries per bucket, access clock.
+# Every entry: check, depth, best move id, score, last time it was used.
+# The check is the position hash xor-ed with the data, so an entry half written by another process is never returned.
+ENTRY = struct.Struct("<QiidQ")
+FLOAT_BITS = struct.Struct("<d")
+INT_BITS = struct.Struct("<Q")
+
+
+class AnalysisCache():
+    """A size-bounded map from a position hash to (depth, score, best move id).
+    Positions are spread over buckets of a few entries each. When a bucket is full, its least recently used entry
+    is replaced.
+    path=None keeps the cache in anonymous shared memory, which is only shared with processes forked from this one."""
+
+    def __init__(self, path=None, size=2 ** 16, ways=4):
+        self.path = path
+        self.file = None
+        buckets = max(1, size // ways)
+        if path is not None and os.path.exists(path) and os.path.getsize(path) >= HEADER.size:
+            # Reuse the layout of an existing cache so it's never thrown away because of a different size.
+            with open(path, "rb") as f:
+                magic, file_buckets, file_ways, _ = HEADER.unpack(f.read(HEADER.size))
+            if magic == MAGIC and os.path.getsize(path) == HEADER.size + file_buckets * file_ways * ENTRY.size:
+                buckets, ways = file_buckets, file_ways
+        self.buckets = buckets
+        self.ways = ways
+        length = HEADER.size + buckets * ways * ENTRY.size
+        if path is None:
+            self.mm = mmap.mmap(-1, length)
+            HEADER.pack_into(self.mm, 0, MAGIC, buckets, ways, 0)
+            return
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        if os.path.getsize(path) != length:
+            # A new or unusable file, start with an empty cache.
+            self.file.truncate(0)
+            self.file.truncate(length)
+        self.mm = mmap.mmap(self.file.fileno(), length)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            HEADER.pack_into(self.mm, 0, MAGIC, buckets, ways, 0)
+
+    def __getstate__(self):
+        """Only the path is sent to other processes, which open the same file."""
+        if self.path is None:
+            raise TypeError("An in-memory AnalysisCache can't be sent to another process, give it a path.")
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @staticmethod
+    def check(position_hash, depth, move_id, score):
+        data = (depth & 0xFFFFFFFF) << 32 | (move_id & 0xFFFFFFFF)
+        return position_hash ^ data ^ INT_BITS.unpack(FLOAT_BITS.pack(score))[0]
+
+    def tick(self):
+        """Advance the access clock shared by all the processes. Concurrent ticks may be lost, which only makes the
+        eviction order slightly less exact."""
+        clock = HEADER.unpack_from(self.mm, 0)[3] + 1
+        struct.pack_into("<Q", self.mm, HEADER.size - 8, clock)
+        return clock
+
+    def bucket_offsets(self, position_hash):
+        start = HEADER.size + (position_hash % self.buckets) * self.ways * ENTRY.size
+        return range(start, start + self.ways * ENTRY.size, ENTRY.size)
+
+    def get(self, position_hash):
+        """Returns (depth, score, best move id) of the position or None if it isn't in the cache."""
+        for offset in self.bucket_offsets(position_hash):
+            check, depth, move_id, score, _ = ENTRY.unpack_from(self.mm, offset)
+            if check != 0 and check == self.check(position_hash, depth, move_id, score):
+                struct.pack_into("<Q", self.mm, offset + ENTRY.size - 8, self.tick())
+                return depth, score, move_id
+        return None
+
+    def put(self, position_hash, depth, score, move_id):
+        """Store the analysis of a position. An existing analysis is only replaced by one at least as deep."""
+        victim = None
+        victim_last_used = None
+        for offset in self.bucket_offsets(position_hash):
+            check, old_depth, old_move_id, old_score, last_used = ENTRY.unpack_from(self.mm, offset)
+            if check != 0 and check == self.check(position_hash, old_depth, old_move_id, old_score):
+                if depth < old_depth:
+                    return
+                victim = offset
+                break
+            if victim is None or last_used < victim_last_used:
+                victim = offset
+                victim_last_used = last_used
+        ENTRY.pack_into(self.mm, victim, self.check(position_hash, depth, move_id, score), depth, move_id, score,
+                        self.tick())
+
+    def __len__(self):
+        return sum(1 for offset in range(HEADER.size, len(self.mm), ENTRY.size)
+                   if ENTRY.unpack_from(self.mm, offset)[0] != 0)
+
+    def clear(self):
+        self.mm[HEADER.size:] = bytes(len(self.mm) - HEADER.size)
+
+    def save(self, path=None):
+        """Write the cache to disk. With a path, a copy is written there and can be opened with load."""
+        if path is None or path == self.path:
+            if self.file is None:
+                raise ValueError("An in-memory AnalysisCache needs a path to be saved to.")
+            self.mm.flush()
+        else:
+            with open(path, "wb") as f:
+                f.write(self.mm[:])
+
+    @classmethod
+    def load(cls, path):
+        """Open a saved cache."""
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return cls(path)
+
+    def close(self):
+        self.mm.close()
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,196 @@
+"""
+This file is responsible for benchmarking the engine so we can tell whether a change made it faster or slower.
+Every run is appended to a JSON lines history file and compared against a stored baseline.
+Usage: python benchmark.py [--repeat N] [--threshold T] [--only NAME ...] [--disable FEATURE ...] [--save-baseline]
+The exit code is 1 if any workload regressed beyond the threshold.
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from queue import Queue
+
+import chess
+import chessAI
+
+HISTORY_FILE = "benchmark_history.jsonl"
+BASELINE_FILE = "benchmark_baseline.json"
+# The chessAI search features that can be turned off with --disable, to compare the engine with and without them.
+SEARCH_FEATURES = ["NULL_MOVE_PRUNING", "LATE_MOVE_REDUCTIONS", "PRINCIPAL_VARIATION_SEARCH", "CHECK_EXTENSIONS"]
+THRESHOLD = 0.10  # A workload has regressed if it got more than 10% slower...
+NOISE_FACTOR = 3  # ...and the slowdown is bigger than 3 times the spread of the measurements.
+
+MIDDLEGAME_FENS = [
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "r1bq1rk1/pp2ppbp/2np1np1/8/3NP3/2N1BP2/PPPQ2PP/R3KB1R w KQ - 0 1",
+    "r2q1rk1/ppp2ppp/2n1bn2/2bpp3/4P3/2PP1N2/PP1NBPPP/R1BQ1RK1 w - - 0 1",
+]
+ENDGAME_FENS = [
+    "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+    "8/8/4k3/8/2p5/8/B2P2K1/8 w - - 0 1",
+    "6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1",
+]
+
+
+def perft(gs, depth):
+    """Count the leaf nodes of the move tree up to depth. Pawns are always promoted to queens."""
+    moves = gs.get_valid_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        gs.make_move(move, promoted_pawn='Q')
+        nodes += perft(gs, depth - 1)
+        gs.undo_move()
+    return nodes
+
+
+def random_positions(count, seed=0, max_plies=40):
+    """Generate a fixed set of positions by playing random games from the starting position."""
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        gs = chess.GameState()
+        for _ in range(rng.randint(1, max_plies)):
+            moves = gs.get_valid_moves()
+            if not moves:
+                break
+            gs.make_move(rng.choice(moves), promoted_pawn='Q')
+        positions.append(gs.get_fen())
+    return positions
+
+
+# Every workload returns a checksum (node counts, scores, ...) so a change in behaviour doesn't go unnoticed.
+def bench_perft(fen, depth):
+    return lambda: perft(chess.GameState(fen), depth)
+
+
+def bench_search(fens, depth):
+    def run():
+        old_depth = chessAI.DEPTH
+        chessAI.DEPTH = depth
+        nodes = 0
+        try:
+            for fen in fens:
+                gs = chess.GameState(fen)
+                random.seed(0)  # find_best_move shuffles the moves.
+                chessAI.transposition_table.clear()  # Every run starts from the same empty table.
+                return_queue = Queue()
+                chessAI.find_best_move(gs, gs.get_valid_moves(), return_queue)
+                nodes += return_queue.get()[1].nodes
+        finally:
+            chessAI.DEPTH = old_depth
+        return nodes
+    return run
+
+
+def bench_score_board(positions, repeat):
+    states = [chess.GameState(fen) for fen in positions]
+
+    def run():
+        total = 0
+        for _ in range(repeat):
+            for gs in states:
+                total += chessAI.score_board(gs)
+        return round(total, 3)
+    return run
+
+
+def bench_valid_moves(fens, repeat):
+    states = [chess.GameState(fen) for fen in fens]
+
+    def run():
+        count = 0
+        for _ in range(repeat):
+            for gs in states:
+                count += len(gs.get_valid_moves())
+        return count
+    return run
+
+
+# The workloads are built only when they are run, so the setup (e.g. generating positions) is never timed.
+WORKLOADS = {
+    "perft_start_3": lambda: bench_perft(chess.GameState().get_fen(), 3),
+    "perft_kiwipete_2": lambda: bench_perft(MIDDLEGAME_FENS[0], 2),
+    "perft_endgame_3": lambda: bench_perft(ENDGAME_FENS[0], 3),
+    "search_middlegame_2": lambda: bench_search(MIDDLEGAME_FENS[1:], 2),  # Kiwipete alone takes seconds.
+    "search_endgame_2": lambda: bench_search(ENDGAME_FENS, 2),
+    "score_board_1000": lambda: bench_score_board(random_positions(100), 10),
+    "get_valid_moves": lambda: bench_valid_moves(MIDDLEGAME_FENS + ENDGAME_FENS, 20),
+}
+
+
+def run_workload(workload, repeat):
+    """Run the workload repeat times and return its timings and checksum."""
+    times = []
+    checksum = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        checksum = workload()
+        times.append(time.perf_counter() - start)
+    median = statistics.median(times)
+    mad = statistics.median([abs(t - median) for t in times])  # Median absolute deviation, robust to outliers.
+    return {"median": median, "mad": mad, "min": min(times), "times": times, "checksum": checksum}
+
+
+def compare(result, baseline, threshold=THRESHOLD):
+    """Compare a workload's result to its baseline. Returns (relative change, noise, regressed)."""
+    change = (result["median"] - baseline["median"]) / baseline["median"]
+    # The relative spread of the noisier of the two runs.
+    noise = NOISE_FACTOR * max(result["mad"] / result["median"], baseline["mad"] / baseline["median"])
+    return change, noise, change > threshold and change > noise
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chess engine.")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs of every workload")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="relative slowdown that fails the run")
+    parser.add_argument("--only", nargs="+", choices=list(WORKLOADS), help="only run these workloads")
+    parser.add_argument("--disable", nargs="+", default=[], choices=SEARCH_FEATURES, help="search features to turn off")
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    args = parser.parse_args()
+
+    for feature in args.disable:
+        setattr(chessAI, feature, False)
+
+    results = {}
+    for name in args.only or WORKLOADS:
+        results[name] = run_workload(WORKLOADS[name](), args.repeat)
+        print(f"{name:<24}{results[name]['median'] * 1000:>10.1f} ms  (+/- {results[name]['mad'] * 1000:.1f})")
+
+    with open(args.history, "a") as f:
+        f.write(json.dumps({"time": time.time(), "disabled": args.disable, "results": results}) + "\n")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"No baseline found at {args.baseline}, run with --save-baseline to create one.")
+        return 0
+
+    failed = False
+    print(f"\n{'workload':<24}{'change':>10}{'noise':>10}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change, noise, regressed = compare(result, baseline[name], args.threshold)
+        status = "REGRESSED" if regressed else ""
+        if result["checksum"] != baseline[name]["checksum"]:
+            status += " (checksum changed)"
+        print(f"{name:<24}{change:>+10.1%}{noise:>10.1%}  {status}")
+        failed = failed or regressed
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
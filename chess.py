@@ -2,11 +2,28 @@
 This file is responsible for storing all the information about the current state of the game.
 It will also be responsible for determining the current available moves and keep a move log.
 """
-from copy import deepcopy
+import random
+
+# Random numbers used to hash positions (Zobrist hashing). The generator is seeded so that a position has the same
+# hash in every process.
+_zobrist_random = random.Random(0x70DA)
+ZOBRIST_PIECES = {color + piece: [[_zobrist_random.getrandbits(64) for col in range(8)] for row in range(8)]
+                  for color in "wb" for piece in "PRNBQK"}
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+ZOBRIST_CASTLING = [_zobrist_random.getrandbits(64) for i in range(16)]  # One for every combination of rights.
+ZOBRIST_EN_PASSANT = [_zobrist_random.getrandbits(64) for col in range(8)]  # One for every file.
+# Used to try the captures of the most valuable pieces by the least valuable pieces first.
+MVV_LVA_VALUES = {'-': 0, 'P': 1, 'N': 3, 'B': 3, 'R': 5, 'Q': 9, 'K': 10}
+# Snapshots store every square in 4 bits (the index of its piece in this list), followed by a byte for the player to
+# move and the castling rights and a byte for the en passant square.
+SNAPSHOT_PIECES = ["--", "wP", "wN", "wB", "wR", "wQ", "wK", "bP", "bN", "bB", "bR", "bQ", "bK"]
+SNAPSHOT_CODES = {piece: code for code, piece in enumerate(SNAPSHOT_PIECES)}
+SNAPSHOT_SIZE = 34
+NO_EN_PASSANT = 0xFF
 
 
 class GameState():
-    def __init__(self):
+    def __init__(self, fen=None):
         # The first letter represents the color of the piece either (b)lack of (w)hite.
         # The second letter represents the piece (R->Rook, N->Knight, B->Bishop, Q->Queen, K->King, P->Pawn).
         # (--) represents an empty space on the board.
@@ -20,9 +37,6 @@ class GameState():
             ["wP", "wP", "wP", "wP", "wP", "wP", "wP", "wP"],
             ["wR", "wN", "wB", "wQ", "wK", "wB", "wN", "wR"]
         ]
-        # A dictionary to map the getting moves functions to their right piece.
-        self.get_moves_functions = {'P': self.get_pawn_moves, 'R': self.get_rook_moves, 'N': self.get_knight_moves,
-                                    'B': self.get_bishop_moves, 'Q': self.get_queen_moves, 'K': self.get_king_moves}
         self.white_to_move = True
         self.move_log = []
         # Keep track of the two kings' locations.
@@ -32,9 +46,163 @@ class GameState():
         self.stalemate = False
         # To handle en passant.
         self.en_passant_possible = ()   # Coordinates for the possible square of enpassant.
-        
+        self.en_passant_log = [self.en_passant_possible]
+
         self.current_castling_rights = CastleRights(True, True, True, True)
-        self.castle_rights_log = [deepcopy(self.current_castling_rights)]
+        self.castle_rights_log = [self.current_castling_rights.copy()]
+        if fen is not None:
+            self.load_fen(fen)
+
+    def load_fen(self, fen):
+        """Set up the position described by a FEN string. The halfmove and fullmove counters are ignored.
+        Raises ValueError if the FEN doesn't describe a board the engine can play on."""
+        fields = fen.split()
+        if not fields:
+            raise ValueError("empty FEN")
+        ranks = fields[0].split('/')
+        if len(ranks) != 8:
+            raise ValueError(f"expected 8 ranks, got {len(ranks)}")
+        board = []
+        for rank in ranks:
+            row = []
+            for char in rank:
+                if char in "12345678":
+                    row.extend(["--"] * int(char))  # A digit is the number of empty squares.
+                elif char in "PNBRQKpnbrqk":
+                    # Uppercase letters are white pieces, lowercase letters are black pieces.
+                    row.append(('w' if char.isupper() else 'b') + char.upper())
+                else:
+                    raise ValueError(f"unknown piece {char!r}")
+            if len(row) != 8:
+                raise ValueError(f"rank {rank!r} doesn't have 8 files")
+            board.append(row)
+        squares = [square for row in board for square in row]
+        if squares.count("wK") != 1 or squares.count("bK") != 1:
+            raise ValueError("there must be exactly one king of each color")
+        if any(square[1] == 'P' for square in board[0] + board[7]):
+            raise ValueError("pawns can't stand on the first or the last rank")
+        if len(fields) > 1 and fields[1] not in ('w', 'b'):
+            raise ValueError(f"unknown side to move {fields[1]!r}")
+        castling = fields[2] if len(fields) > 2 else '-'
+        if castling != '-' and (set(castling) - set("KQkq") or len(set(castling)) != len(castling)):
+            raise ValueError(f"invalid castling rights {castling!r}")
+        en_passant = fields[3] if len(fields) > 3 else '-'
+        if en_passant != '-' and (len(en_passant) != 2 or en_passant[0] not in Move.files_to_cols
+                                  or en_passant[1] not in Move.ranks_to_rows):
+            raise ValueError(f"invalid en passant square {en_passant!r}")
+        self.board = board
+        for row in range(8):
+            for col in range(8):
+                if self.board[row][col] == "wK":
+                    self.white_king_location = (row, col)
+                elif self.board[row][col] == "bK":
+                    self.black_king_location = (row, col)
+        self.white_to_move = len(fields) < 2 or fields[1] == 'w'
+        # A right is dropped unless its king and rook are still on their starting squares.
+        self.current_castling_rights = CastleRights(
+            'K' in castling and board[7][4] == "wK" and board[7][7] == "wR",
+            'k' in castling and board[0][4] == "bK" and board[0][7] == "bR",
+            'Q' in castling and board[7][4] == "wK" and board[7][0] == "wR",
+            'q' in castling and board[0][4] == "bK" and board[0][0] == "bR")
+        self.castle_rights_log = [self.current_castling_rights.copy()]
+        if en_passant != '-':
+            self.en_passant_possible = (Move.ranks_to_rows[en_passant[1]], Move.files_to_cols[en_passant[0]])
+        else:
+            self.en_passant_possible = ()
+        self.en_passant_log = [self.en_passant_possible]
+        self.move_log = []
+        self.checkmate = False
+        self.stalemate = False
+
+    def get_fen(self):
+        """The FEN string of the current position. The halfmove and fullmove counters are always 0 and 1."""
+        ranks = []
+        for row in self.board:
+            rank = ""
+            empty = 0
+            for square in row:
+                if square == "--":
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += square[1] if square[0] == 'w' else square[1].lower()
+            if empty:
+                rank += str(empty)
+            ranks.append(rank)
+        rights = self.current_castling_rights
+        castling = (("K" if rights.wks else "") + ("Q" if rights.wqs else "") +
+                    ("k" if rights.bks else "") + ("q" if rights.bqs else "")) or "-"
+        if self.en_passant_possible:
+            en_passant = Move.cols_to_files[self.en_passant_possible[1]] + Move.rows_to_ranks[self.en_passant_possible[0]]
+        else:
+            en_passant = "-"
+        return f"{'/'.join(ranks)} {'w' if self.white_to_move else 'b'} {castling} {en_passant} 0 1"
+
+    def clone(self):
+        """A copy of the current position that doesn't carry the game history, made in constant time.
+        Moves made on the clone can be undone back to the cloned position but not further."""
+        gs = GameState.__new__(GameState)
+        gs.board = [row[:] for row in self.board]
+        gs.white_to_move = self.white_to_move
+        gs.move_log = []
+        gs.white_king_location = self.white_king_location
+        gs.black_king_location = self.black_king_location
+        gs.checkmate = self.checkmate
+        gs.stalemate = self.stalemate
+        gs.en_passant_possible = self.en_passant_possible
+        gs.en_passant_log = [gs.en_passant_possible]
+        gs.current_castling_rights = self.current_castling_rights.copy()
+        gs.castle_rights_log = [gs.current_castling_rights.copy()]
+        return gs
+
+    def to_bytes(self):
+        """Pack the position (the board, the player to move, the castling rights and the en passant square) into
+        SNAPSHOT_SIZE bytes. The game history isn't included, so the size never grows."""
+        data = bytearray(SNAPSHOT_SIZE)
+        squares = [SNAPSHOT_CODES[square] for row in self.board for square in row]
+        for i in range(32):
+            data[i] = squares[2*i] << 4 | squares[2*i + 1]   # Two squares per byte.
+        rights = self.current_castling_rights
+        data[32] = self.white_to_move | rights.wks << 1 | rights.bks << 2 | rights.wqs << 3 | rights.bqs << 4
+        if self.en_passant_possible:
+            data[33] = self.en_passant_possible[0] << 4 | self.en_passant_possible[1]
+        else:
+            data[33] = NO_EN_PASSANT
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Rebuild a position packed with to_bytes. The result has no game history, like a clone.
+        Raises ValueError if the data isn't a snapshot of a position with exactly one king per side."""
+        if len(data) != SNAPSHOT_SIZE:
+            raise ValueError(f"a snapshot is {SNAPSHOT_SIZE} bytes long, got {len(data)}")
+        gs = cls.__new__(cls)
+        gs.board = []
+        for row in range(8):
+            gs.board.append([])
+            for byte in data[row*4:row*4 + 4]:
+                if byte >> 4 >= len(SNAPSHOT_PIECES) or byte & 0xF >= len(SNAPSHOT_PIECES):
+                    raise ValueError(f"invalid piece code in snapshot byte {byte}")
+                gs.board[row].append(SNAPSHOT_PIECES[byte >> 4])
+                gs.board[row].append(SNAPSHOT_PIECES[byte & 0xF])
+        kings = {piece: [(row, col) for row in range(8) for col in range(8) if gs.board[row][col] == piece]
+                 for piece in ("wK", "bK")}
+        if len(kings["wK"]) != 1 or len(kings["bK"]) != 1:
+            raise ValueError("a snapshot must have exactly one king per side")
+        gs.white_king_location = kings["wK"][0]
+        gs.black_king_location = kings["bK"][0]
+        flags = data[32]
+        gs.white_to_move = bool(flags & 1)
+        gs.current_castling_rights = CastleRights(bool(flags & 2), bool(flags & 4), bool(flags & 8), bool(flags & 16))
+        gs.castle_rights_log = [gs.current_castling_rights.copy()]
+        gs.en_passant_possible = () if data[33] == NO_EN_PASSANT else (data[33] >> 4, data[33] & 0xF)
+        gs.en_passant_log = [gs.en_passant_possible]
+        gs.move_log = []
+        gs.checkmate = False
+        gs.stalemate = False
+        return gs
 
     def make_move(self, move, promoted_pawn=""):
         """Takes a  move and excutes it."""
@@ -59,6 +227,7 @@ class GameState():
             self.en_passant_possible = ((move.start_row + move.end_row) // 2, move.start_col)
         else:
             self.en_passant_possible = ()   # Reset.
+        self.en_passant_log.append(self.en_passant_possible)
 
         # Castle move.
         if move.is_castle_move:
@@ -73,7 +242,7 @@ class GameState():
 
         # Update castling rights whenever it's a rook or a king move.
         self.update_castle_rights(move)
-        self.castle_rights_log.append(deepcopy(self.current_castling_rights))
+        self.castle_rights_log.append(self.current_castling_rights.copy())
 
     def undo_move(self):
         """An undo function to undo the last move. This function will be excuted on pressing 'z'."""
@@ -94,16 +263,14 @@ class GameState():
                 self.board[move.end_row][move.end_col] = "--"   # Keeping the landing square empty.
                 # Retruning the piece to its initial place.
                 self.board[move.start_row][move.end_col] = move.piece_captured
-                # Reset so we can redo the move after undoing the move.
-                self.en_passant_possible = (move.end_row, move.end_col)
-            # Undo a 2 square pawn advance. We have to reset the en_passant_possible field to ().
-            if move.piece_moved[1] == 'P' and abs(move.start_row - move.end_row) == 2:
-                self.en_passant_possible = ()
+            # Restore the en passant square from before the move.
+            self.en_passant_log.pop()
+            self.en_passant_possible = self.en_passant_log[-1]
 
             # Undo castling rights.
             self.castle_rights_log.pop()  # Get rid of the new casle rights from the move we are undoing.
             # set the current casle rights to the last one in the log.
-            castle_rights = deepcopy(self.castle_rights_log[-1])
+            castle_rights = self.castle_rights_log[-1].copy()
             self.current_castling_rights = castle_rights
 
             # Undo the castle move.
@@ -120,6 +287,17 @@ class GameState():
             self.stalemate = False
 
             
+    def make_null_move(self):
+        """Pass the turn to the opponent without moving. Only used by the search (null move pruning)."""
+        self.white_to_move = not self.white_to_move
+        self.en_passant_possible = ()
+        self.en_passant_log.append(self.en_passant_possible)
+
+    def undo_null_move(self):
+        self.white_to_move = not self.white_to_move
+        self.en_passant_log.pop()
+        self.en_passant_possible = self.en_passant_log[-1]
+
     def update_castle_rights(self, move):
         """Update the castle rigths given the move."""
         # If the king is moved, all castling rights are lost.
@@ -161,7 +339,7 @@ class GameState():
     def get_valid_moves(self):
         """All moves considering checks."""
         temp_enpassant_possible = self.en_passant_possible   # Saving the contents of the field so we can undo later.
-        temp_castle_rights = deepcopy(self.current_castling_rights)  # Copy the current castling rights.
+        temp_castle_rights = self.current_castling_rights.copy()  # Copy the current castling rights.
         # 1- Get all possible move.
         moves = self.get_possible_moves()
 
@@ -199,6 +377,106 @@ class GameState():
         self.current_castling_rights = temp_castle_rights
         return moves
 
+    def get_staged_moves(self, hash_move_id=None, killer_ids=()):
+        """A generator of the valid moves in the order a search wants to try them: the hash move, the captures (most
+        valuable victim first) and promotions, the killer moves and then the rest of the quiet moves.
+        A move's legality is only checked right before it's yielded and castle moves are only generated once the
+        quiet moves are reached, so a search that cuts off early skips most of the work.
+        The position must be the same every time the generator is resumed.
+        The checkmate and stalemate flags are set once the generator runs out of moves."""
+        self.checkmate = False
+        self.stalemate = False
+        found = False   # Whether at least one valid move was yielded.
+        tried = set()   # The ids of the moves that were already yielded (or found to be illegal).
+
+        # 1- The hash move, only the moves of the piece on its start square are generated.
+        if hash_move_id is not None:
+            row, col = hash_move_id // 1000, hash_move_id // 100 % 10
+            piece = self.board[row][col]
+            if piece[0] == ('w' if self.white_to_move else 'b'):
+                moves = []
+                self.get_moves_functions[piece[1]](self, row, col, moves)
+                for move in moves:
+                    if move.move_id == hash_move_id:
+                        tried.add(move.move_id)
+                        if self.is_legal(move):
+                            found = True
+                            yield move
+                        break
+
+        # 2- Captures and promotions.
+        moves = self.get_possible_moves()
+        captures = []
+        quiet_moves = []
+        for move in moves:
+            if move.piece_captured != '--' or move.is_pawn_promotion:
+                captures.append(move)
+            else:
+                quiet_moves.append(move)
+        captures.sort(key=lambda move: (MVV_LVA_VALUES[move.piece_captured[1]] * 10 -
+                                        MVV_LVA_VALUES[move.piece_moved[1]]), reverse=True)
+        for move in captures:
+            if move.move_id not in tried:
+                tried.add(move.move_id)
+                if self.is_legal(move):
+                    found = True
+                    yield move
+
+        # 3- Killer moves: quiet moves that caused a cutoff in a sibling position.
+        for killer_id in killer_ids:
+            if killer_id in tried:
+                continue
+            for move in quiet_moves:
+                if move.move_id == killer_id:
+                    tried.add(move.move_id)
+                    if self.is_legal(move):
+                        found = True
+                        yield move
+                    break
+
+        # 4- The rest of the quiet moves and castling.
+        if self.white_to_move:
+            self.get_castle_moves(*self.white_king_location, quiet_moves)
+        else:
+            self.get_castle_moves(*self.black_king_location, quiet_moves)
+        for move in quiet_moves:
+            if move.move_id not in tried and self.is_legal(move):
+                found = True
+                yield move
+
+        if not found:
+            # Either a checkmate or a stalemate.
+            if self.in_check():
+                self.checkmate = True
+            else:
+                self.stalemate = True
+
+    def is_legal(self, move):
+        """Determine if a move doesn't leave the player's own king in check."""
+        self.make_move(move)  # This function switchs turns.
+        self.white_to_move = not self.white_to_move  # Switch the turns to see if the king is in check.
+        legal = not self.in_check()
+        self.white_to_move = not self.white_to_move
+        self.undo_move()
+        return legal
+
+    def get_hash(self):
+        """A 64 bit Zobrist hash of the position: the board, the player to move, the castling rights and the
+        en passant file."""
+        h = 0
+        for row in range(8):
+            for col in range(8):
+                square = self.board[row][col]
+                if square != "--":
+                    h ^= ZOBRIST_PIECES[square][row][col]
+        if not self.white_to_move:
+            h ^= ZOBRIST_BLACK_TO_MOVE
+        rights = self.current_castling_rights
+        h ^= ZOBRIST_CASTLING[rights.wks | rights.bks << 1 | rights.wqs << 2 | rights.bqs << 3]
+        if self.en_passant_possible:
+            h ^= ZOBRIST_EN_PASSANT[self.en_passant_possible[1]]
+        return h
+
     def in_check(self):
         """"Determine if the player is in check."""
         if self.white_to_move:
@@ -229,7 +507,7 @@ class GameState():
                     # Get the second character as the name of the piece.
                     piece = self.board[row][col][1]
                     # Calling the function that generates the piece's possible moves.
-                    self.get_moves_functions[piece](row, col, moves)
+                    self.get_moves_functions[piece](self, row, col, moves)
         return moves
 
     def get_pawn_moves(self, row, col, moves):
@@ -385,6 +663,11 @@ class GameState():
             if not self.square_under_attack(row, col-1) and not self.square_under_attack(row, col-2):
                 moves.append(Move((row, col), (row, col-2), self.board, is_castle_move=True))
 
+    # A dictionary to map the getting moves functions to their right piece. Called with the game state as the first
+    # argument, so that the game state doesn't have to carry bound methods around.
+    get_moves_functions = {'P': get_pawn_moves, 'R': get_rook_moves, 'N': get_knight_moves,
+                           'B': get_bishop_moves, 'Q': get_queen_moves, 'K': get_king_moves}
+
 
 class CastleRights():
     def __init__(self, wks, bks, wqs, bqs):  # white king side, black king side,...
@@ -393,6 +676,9 @@ class CastleRights():
         self.wqs = wqs
         self.bqs = bqs
 
+    def copy(self):
+        return CastleRights(self.wks, self.bks, self.wqs, self.bqs)
+
 
 class Move():
 
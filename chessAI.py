@@ -1,4 +1,6 @@
+import json
 import random
+import time
 
 PIECE_SCORE = {"K": 0, "Q": 10, "R": 5, "B": 3, "N": 3, "P": 1}
 # Knights have higher score when they are near the middle of the board.
@@ -67,6 +69,19 @@ PIECE_POSITION_SCORES = {'N': KNIGHT_SCORES, 'Q': QUEEN_SCORES,
 CHECKMATE = 1000  # Highest score.
 STALEMATE = 0  # Better than losing, but not as good as checkmate.
 DEPTH = 1   # How deep we want to go into the game moves.
+# Transposition table entry flags: whether the stored score is exact or only a bound.
+EXACT, LOWER_BOUND, UPPER_BOUND = 0, 1, 2
+TT_SIZE = 2 ** 18   # Maximum number of positions in the transposition table before it's cleared.
+transposition_table = {}   # Position hash -> (depth, score, flag, best move id).
+# Selective search features, each of them can be turned off to compare the engine with and without it.
+NULL_MOVE_PRUNING = True
+LATE_MOVE_REDUCTIONS = True
+PRINCIPAL_VARIATION_SEARCH = True
+CHECK_EXTENSIONS = True
+NULL_MOVE_REDUCTION = 2   # How much shallower the null move is searched.
+LMR_MIN_MOVES = 3   # Moves tried before this many others are never reduced.
+LMR_MIN_DEPTH = 3
+NULL_WINDOW = 0.05   # Width of a zero-width window, smaller than the smallest difference between two scores (0.1).
 
 
 def find_random_move(valid_moves):
@@ -108,13 +123,114 @@ def find_random_move(valid_moves):
     return best_player_move"""
 
 
-def find_best_move(gs, valid_moves, return_queue):
-    """This function will make the first recursive call for the negamax algorithm."""
-    global next_move
+class SearchStats():
+    """Counters and timers collected while searching for a single move."""
+
+    def __init__(self, depth=DEPTH):
+        self.depth = depth  # The depth the search was asked to reach.
+        self.depth_reached = 0  # The deepest ply actually visited.
+        self.nodes = 0
+        self.nodes_per_ply = [0] * (depth + 1)   # Grows if check extensions take the search deeper.
+        self.quiescence_nodes = 0
+        self.cutoffs = 0
+        self.first_move_cutoffs = 0  # Cutoffs caused by the first move searched, a measure of move ordering.
+        self.tt_probes = 0
+        self.tt_hits = 0
+        # Time (in seconds) spent in each phase of the search.
+        self.move_generation_time = 0.0
+        self.evaluation_time = 0.0
+        self.ordering_time = 0.0
+        self.analysis_cache_hit = False   # The move came from the analysis cache, nothing was searched.
+        self.elapsed = 0.0
+        self.start_time = time.perf_counter()
+
+    def finish(self):
+        """Stop the clock. Called once the search is over."""
+        self.elapsed = time.perf_counter() - self.start_time
+
+    def nodes_per_second(self):
+        return (self.nodes + self.quiescence_nodes) / self.elapsed if self.elapsed > 0 else 0.0
+
+    def first_move_cutoff_rate(self):
+        return self.first_move_cutoffs / self.cutoffs if self.cutoffs else 0.0
+
+    def tt_hit_rate(self):
+        return self.tt_hits / self.tt_probes if self.tt_probes else 0.0
+
+    def effective_branching_factor(self):
+        """The ratio between the number of nodes in the deepest full ply and the ply before it.
+        The plies only reached through check extensions are left out."""
+        depth = min(self.depth, self.depth_reached)
+        if depth == 0 or self.nodes_per_ply[depth - 1] == 0:
+            return 0.0
+        return self.nodes_per_ply[depth] / self.nodes_per_ply[depth - 1]
+
+    def to_dict(self):
+        return {
+            "depth": self.depth,
+            "depth_reached": self.depth_reached,
+            "nodes": self.nodes,
+            "nodes_per_ply": self.nodes_per_ply,
+            "quiescence_nodes": self.quiescence_nodes,
+            "nps": round(self.nodes_per_second(), 1),
+            "cutoffs": self.cutoffs,
+            "first_move_cutoff_rate": round(self.first_move_cutoff_rate(), 4),
+            "tt_probes": self.tt_probes,
+            "tt_hits": self.tt_hits,
+            "tt_hit_rate": round(self.tt_hit_rate(), 4),
+            "effective_branching_factor": round(self.effective_branching_factor(), 2),
+            "move_generation_time": round(self.move_generation_time, 6),
+            "evaluation_time": round(self.evaluation_time, 6),
+            "ordering_time": round(self.ordering_time, 6),
+            "elapsed": round(self.elapsed, 6),
+            "analysis_cache_hit": self.analysis_cache_hit,
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def write_jsonl(self, path):
+        """Append the stats as a single line to a JSON lines file."""
+        with open(path, "a") as f:
+            f.write(self.to_json() + "\n")
+
+    def summary(self):
+        if self.analysis_cache_hit:
+            return f"depth {self.depth}, from the analysis cache"
+        return (f"depth {self.depth_reached}/{self.depth}, {self.nodes} nodes, "
+                f"{self.nodes_per_second():.0f} nps, ebf {self.effective_branching_factor():.2f}, "
+                f"{self.elapsed:.3f}s")
+
+
+def find_best_move(gs, valid_moves, return_queue, analysis_cache=None):
+    """This function will make the first recursive call for the negamax algorithm.
+    Puts a (best move, search stats) tuple on the return queue.
+    If an analysis_cache.AnalysisCache is given, a position already analysed at least as deep is only looked up,
+    and the result of a new search is stored in it."""
+    global next_move, search_stats, killer_moves
     next_move = None
+    search_stats = SearchStats(DEPTH)
+    if analysis_cache is not None:
+        position_hash = gs.get_hash()
+        entry = analysis_cache.get(position_hash)
+        if entry is not None and entry[0] >= DEPTH:
+            for move in valid_moves:
+                if move.move_id == entry[2]:
+                    search_stats.analysis_cache_hit = True
+                    search_stats.finish()
+                    return_queue.put((move, search_stats))
+                    return
+    # The last two quiet moves that caused a cutoff at every ply. Check extensions are only made in the first
+    # 2 * DEPTH plies, so the search never goes deeper than 3 * DEPTH.
+    killer_moves = [[] for _ in range(3 * DEPTH + 1)]
+    if len(transposition_table) > TT_SIZE:
+        transposition_table.clear()
     random.shuffle(valid_moves)
-    find_move_nega_max_alpha_beta(gs, valid_moves, DEPTH, -CHECKMATE, CHECKMATE, 1 if gs.white_to_move else -1)
-    return_queue.put(next_move)
+    score = find_move_nega_max_alpha_beta(gs, valid_moves, DEPTH, -CHECKMATE, CHECKMATE, 1 if gs.white_to_move else -1)
+    if analysis_cache is not None and next_move is not None:
+        analysis_cache.put(position_hash, DEPTH, score, next_move.move_id)
+    search_stats.finish()
+    return_queue.put((next_move, search_stats))
 
 # def find_move_min_max(gs, valid_moves, depth, white_to_move):
     """global next_move
@@ -165,32 +281,155 @@ def find_best_move(gs, valid_moves, return_queue):
     return max_score"""
 
 
-def find_move_nega_max_alpha_beta(gs, valid_moves, depth, alpha, beta, turn_multiplier):
-    """We will look for max score, then multipli it by -1 when it's black's turn."""
+def find_move_nega_max_alpha_beta(gs, valid_moves, depth, alpha, beta, turn_multiplier, ply=0, null_move_allowed=True):
+    """We will look for max score, then multipli it by -1 when it's black's turn.
+    valid_moves is only given at the root, deeper positions get their moves from the staged generator so that a
+    cutoff stops the move generation as well. ply is the distance from the root, it differs from DEPTH - depth
+    once moves are extended or reduced."""
     global next_move
-    if depth == 0:
-        return turn_multiplier * score_board(gs)
+    search_stats.nodes += 1
+    if ply >= len(search_stats.nodes_per_ply):
+        search_stats.nodes_per_ply.append(0)
+    search_stats.nodes_per_ply[ply] += 1
+    if ply > search_stats.depth_reached:
+        search_stats.depth_reached = ply
+
+    # Only look for a check when one of the features needs it, it costs a full generation of the opponent's moves.
+    in_check = False
+    if CHECK_EXTENSIONS or ((NULL_MOVE_PRUNING or LATE_MOVE_REDUCTIONS) and
+                            depth >= min(NULL_MOVE_REDUCTION + 1, LMR_MIN_DEPTH)):
+        in_check = gs.in_check()
+    if CHECK_EXTENSIONS and in_check and ply < 2 * DEPTH:
+        depth += 1   # Don't stop searching while in check, there might be a checkmate.
 
-    # move ordering - implement late.
+    if depth <= 0:
+        if valid_moves is None:
+            # Looking for a single valid move is enough to set the checkmate and stalemate flags.
+            start = time.perf_counter()
+            next(gs.get_staged_moves(), None)
+            search_stats.move_generation_time += time.perf_counter() - start
+        start = time.perf_counter()
+        score = turn_multiplier * score_board(gs)
+        search_stats.evaluation_time += time.perf_counter() - start
+        return score
 
+    # Move ordering: the best move found the last time we saw this position is tried first, then the generator
+    # orders the captures and the killer moves.
+    start = time.perf_counter()
+    position_hash = gs.get_hash()
+    hash_move_id = None
+    search_stats.tt_probes += 1
+    entry = transposition_table.get(position_hash)
+    if entry is not None:
+        search_stats.tt_hits += 1
+        entry_depth, entry_score, entry_flag, hash_move_id = entry
+        # Never return early from the root, we need next_move to be set there.
+        if ply > 0 and entry_depth >= depth:
+            if entry_flag == EXACT:
+                return entry_score
+            elif entry_flag == LOWER_BOUND:
+                alpha = max(alpha, entry_score)
+            elif entry_flag == UPPER_BOUND:
+                beta = min(beta, entry_score)
+            if alpha >= beta:
+                return entry_score
+    search_stats.ordering_time += time.perf_counter() - start
+
+    # Null move pruning: if passing the turn still fails high, a real move would too.
+    # Not while in check (passing would be illegal) and not with only pawns left, where zugzwang is common.
+    if (NULL_MOVE_PRUNING and null_move_allowed and ply > 0 and not in_check and depth > NULL_MOVE_REDUCTION
+            and abs(beta) < CHECKMATE and has_non_pawn_material(gs)):
+        gs.make_null_move()
+        score = -find_move_nega_max_alpha_beta(gs, None, depth-1-NULL_MOVE_REDUCTION, -beta, -beta+NULL_WINDOW,
+                                               -turn_multiplier, ply+1, null_move_allowed=False)
+        gs.undo_null_move()
+        if score >= beta:
+            return beta
+
+    start = time.perf_counter()
+    if valid_moves is None:
+        valid_moves = gs.get_staged_moves(hash_move_id, killer_moves[ply])
+    elif hash_move_id is not None:
+        # At the root the moves are a list, move the hash move to the front.
+        valid_moves = sorted(valid_moves, key=lambda move: move.move_id != hash_move_id)
+    search_stats.ordering_time += time.perf_counter() - start
+
+    original_alpha = alpha
     max_score = -CHECKMATE
-    for move in valid_moves:
+    best_move_id = None
+    moves = iter(valid_moves)
+    i = 0
+    moves_searched = 0
+    while True:
+        start = time.perf_counter()
+        move = next(moves, None)
+        search_stats.move_generation_time += time.perf_counter() - start
+        if move is None:
+            break
         gs.make_move(move, promoted_pawn='Q')
-        next_moves = gs.get_valid_moves()
         # Will negate opponent's max score.
-        score = -find_move_nega_max_alpha_beta(gs, next_moves, depth-1, -beta, -alpha,  -turn_multiplier)
-        if score > max_score:
+        if i == 0:
+            score = -find_move_nega_max_alpha_beta(gs, None, depth-1, -beta, -alpha, -turn_multiplier, ply+1)
+        else:
+            # Late move reductions: quiet moves ordered late are unlikely to be good, search them a ply shallower.
+            reduction = 0
+            if (LATE_MOVE_REDUCTIONS and i >= LMR_MIN_MOVES and depth >= LMR_MIN_DEPTH and not in_check
+                    and move.piece_captured == '--' and not move.is_pawn_promotion):
+                reduction = 1
+            # Principal variation search: only prove that the move isn't better than alpha with a zero-width window.
+            child_beta = alpha + NULL_WINDOW if PRINCIPAL_VARIATION_SEARCH else beta
+            score = -find_move_nega_max_alpha_beta(gs, None, depth-1-reduction, -child_beta, -alpha,
+                                                   -turn_multiplier, ply+1)
+            if reduction and score > alpha:
+                # The reduced search says the move might be good, search it to the full depth.
+                score = -find_move_nega_max_alpha_beta(gs, None, depth-1, -child_beta, -alpha, -turn_multiplier,
+                                                       ply+1)
+            if child_beta < beta and alpha < score < beta:
+                # The move is better than the best one so far, search it again with the full window for its score.
+                score = -find_move_nega_max_alpha_beta(gs, None, depth-1, -beta, -alpha, -turn_multiplier, ply+1)
+        gs.undo_move()
+        moves_searched += 1
+        # The first move is always kept, even if it's a forced loss, so every searched position has a best move.
+        if score > max_score or best_move_id is None:
             max_score = score
-            if depth == DEPTH:
+            best_move_id = move.move_id
+            if ply == 0:
                 next_move = move
-        gs.undo_move()
         if max_score > alpha:   # Pruning. Neglecting unnecessary position calculations.
             alpha = max_score
         if alpha >= beta:   # We reached the best possible score. no need to calculate further more.
+            search_stats.cutoffs += 1
+            if i == 0:
+                search_stats.first_move_cutoffs += 1
+            if move.piece_captured == '--' and move.move_id not in killer_moves[ply]:
+                killer_moves[ply] = [move.move_id] + killer_moves[ply][:1]
             break
+        i += 1
+
+    if moves_searched == 0:
+        # No valid moves, the generator has set either the checkmate or the stalemate flag.
+        return turn_multiplier * score_board(gs)
+
+    if max_score <= original_alpha:
+        flag = UPPER_BOUND
+    elif max_score >= beta:
+        flag = LOWER_BOUND
+    else:
+        flag = EXACT
+    transposition_table[position_hash] = (depth, max_score, flag, best_move_id)
     return max_score
 
 
+def has_non_pawn_material(gs):
+    """Determine if the player to move has a piece other than the king and pawns."""
+    color = 'w' if gs.white_to_move else 'b'
+    for row in gs.board:
+        for square in row:
+            if square[0] == color and square[1] in "NBRQ":
+                return True
+    return False
+
+
 def score_board(gs):
     """Positive score is better for white while negative score is better for black."""
     if gs.checkmate:
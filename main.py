@@ -1,41 +1,66 @@
 """
 This file is responsible for handeling user input and displaying the game.
+pygame is only initialized and the piece images are only loaded once main() runs, so processes that re-import this
+module (the search processes under the spawn start method) don't pay for them. pygame still has to be installed to
+import this module; tools that only need the engine should import chess and chessAI, which don't depend on pygame.
 """
 
 import pygame as pg
 import chess
 import chessAI
+from analysis_cache import AnalysisCache
+import os
+import queue
 import random
+import threading
 from multiprocessing import Process, Queue
 
-pg.init()  # Initialize pygame.
-pg.display.set_caption("Chess")
 WIDTH = HEIGHT = 512
 DIMENSION = 8  # A chess board is 8x8
 SQ_SIZE = HEIGHT // DIMENSION
 MAX_FPS = 15
-IMAGES = {}  # Store all the images in this global dictionary only one time at the start of the game.
+SEARCH_STATS_FILE = None  # Path of a JSON lines file to log the stats of every AI search to, None to disable.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# File to keep the positions analysed by the AI in between games, e.g. "analysis.cache" (relative to this file).
+# Off by default: a cached position always gets the same move back, so the AI plays the same games.
+ANALYSIS_CACHE_FILE = None
+IMAGES_DIR = os.path.join(BASE_DIR, "images")
+IMAGES = {}  # Store the images in this global dictionary the first time each of them is drawn.
+COLORS = [pg.Color("white"), pg.Color("grey")]
+# Surfaces that never change are drawn once and reused on every frame.
+BOARD_SURFACE = None
+HIGHLIGHTS = {}  # Highlight color -> transparent square.
+TEXTS = {}  # Text -> (text surface, shadow surface).
+FONT = None
 
 
-def load_images():
-    """Load the images into a global dictionary."""
-    pieces = ["wR", "wN", "wB", "wQ", "wK", "wP", "bR", "bN", "bB", "bQ", "bK", "bP"]
-    for piece in pieces:
-        IMAGES[piece] = pg.transform.scale(pg.image.load(f"images/{piece}.png"), (SQ_SIZE, SQ_SIZE))
+def get_image(piece):
+    """Load and scale the image of a piece the first time it's needed, then reuse it."""
+    if piece not in IMAGES:
+        image = pg.image.load(os.path.join(IMAGES_DIR, f"{piece}.png")).convert_alpha()   # Faster to blit.
+        IMAGES[piece] = pg.transform.scale(image, (SQ_SIZE, SQ_SIZE))
+    return IMAGES[piece]
 
 
 def main():
-    """Handles the user input and updates the graphics."""
+    """Handles the user input and updates the graphics.
+    Move generation and the AI run in the background, the loop only handles input and drawing."""
+    pg.init()  # Initialize pygame.
+    pg.display.set_caption("Chess")
     screen = pg.display.set_mode((WIDTH, HEIGHT))
     clock = pg.time.Clock()
     screen.fill(pg.Color("white"))
+    renderer = Renderer()
+    move_generator = MoveGenerator()
     gs = chess.GameState()
-    valid_moves = gs.get_valid_moves()  # A list to check the valid moves we have and act on them.
+    move_generator.request(gs)
+    valid_moves = []  # A list to check the valid moves we have and act on them. Empty until the generator is done.
+    waiting_for_moves = True
+    pending_promotion = None  # A pawn promotion move waiting for the player to choose the piece.
     promoted_pawn = ""
     animate = False   # A flag for animation.
     move_made = False  # A variable based on we will be generating new valid moves for the new piece.
     game_over = False
-    load_images()
     running = True
     # No square is selected initially. This will keep track of the last click of the user -> (row, col).
     sq_selected = ()
@@ -49,18 +74,38 @@ def main():
     AI_thinking = False
     move_finder_process = None
     move_undone = False
+    # Opened once, every search process reopens the same file and shares it.
+    analysis_cache = None
+    if ANALYSIS_CACHE_FILE:
+        analysis_cache = AnalysisCache(os.path.join(BASE_DIR, ANALYSIS_CACHE_FILE))
     while running:
+        # Pick up the valid moves once the generator is done with them.
+        result = move_generator.poll()
+        if result is not None:
+            valid_moves, gs.checkmate, gs.stalemate = result
+            waiting_for_moves = False
+
         is_human_turn = (gs.white_to_move and player_one) or (not gs.white_to_move and player_two)
         for e in pg.event.get():
             if e.type == pg.QUIT:
                 running = False
             # Mouse handler
             elif e.type == pg.MOUSEBUTTONDOWN:
+                location = pg.mouse.get_pos()  # (x,y) posiotion of the mouse.
+                col = location[0] // SQ_SIZE  # The x coordinate.
+                row = location[1] // SQ_SIZE  # The y coordinate.
+                if pending_promotion is not None:
+                    # Any click outside the promotion choices cancels the move.
+                    for square, piece in get_promotion_choices(pending_promotion):
+                        if square == (row, col):
+                            gs.make_move(pending_promotion, piece[1])
+                            move_made = True
+                            animate = True
+                    pending_promotion = None
+                    sq_selected = ()
+                    player_clicks = []
                 # Allow mouse clicks only if it's a Human player's turn.
-                if not game_over:
-                    location = pg.mouse.get_pos()  # (x,y) posiotion of the mouse.
-                    col = location[0] // SQ_SIZE  # The x coordinate.
-                    row = location[1] // SQ_SIZE  # The y coordinate.
+                elif not game_over:
                     if sq_selected == (row, col):
                         # If the user selected the same square twice, deselect that square.
                         sq_selected = ()
@@ -69,22 +114,27 @@ def main():
                         sq_selected = (row, col)
                         player_clicks.append(sq_selected)
 
-                    if len(player_clicks) == 2 and is_human_turn:
+                    if len(player_clicks) == 2 and is_human_turn and not waiting_for_moves:
                         # After the second click.
                         move = chess.Move(player_clicks[0], player_clicks[1], gs.board)
                         print(move.get_chess_notation())  # for debugging.
                         for i in range(len(valid_moves)):
                             if move == valid_moves[i]:  # Only make a valid move for this piece.
                                 if move.is_pawn_promotion:
-                                    promoted_pawn = input("promote to Q, R, B, N: ")
-                                gs.make_move(valid_moves[i], promoted_pawn)
-                                move_made = True  # Raising a flag that a valid move was made.
-                                animate = True
+                                    # Let the player choose the piece in the window before making the move.
+                                    pending_promotion = valid_moves[i]
+                                else:
+                                    gs.make_move(valid_moves[i], promoted_pawn)
+                                    move_made = True  # Raising a flag that a valid move was made.
+                                    animate = True
                                 # Reset user clicks.
                                 sq_selected = ()
                                 player_clicks = []
-                        if not move_made:
+                        if not move_made and pending_promotion is None:
                             player_clicks = [sq_selected]
+                    elif len(player_clicks) == 2:
+                        # No move can be made yet, the last click becomes the selected square.
+                        player_clicks = [sq_selected]
             # Key handler
             elif e.type == pg.KEYDOWN:
                 if e.key == pg.K_z:  # On pressing the button 'z' on keyboard.
@@ -92,6 +142,7 @@ def main():
                     move_made = True  # will be important in the Ai creation later on.
                     animate = False
                     game_over = False
+                    pending_promotion = None
                     if AI_thinking:
                         move_finder_process.terminate()
                         AI_thinking = False
@@ -99,12 +150,12 @@ def main():
                 # Resetting the game.
                 if e.key == pg.K_r:
                     gs = chess.GameState()
-                    valid_moves = gs.get_valid_moves()
                     sq_selected = ()
                     player_clicks = []
-                    move_made = False
+                    move_made = True
                     animate = False
                     promoted_pawn = ""
+                    pending_promotion = None
                     game_over = False
                     if AI_thinking:
                         move_finder_process.terminate()
@@ -112,17 +163,25 @@ def main():
                     move_undone = True
 
         # AI move finder.
-        if not game_over and not is_human_turn and not move_undone:
+        if not game_over and not is_human_turn and not move_undone and not waiting_for_moves:
             if not AI_thinking:
                 AI_thinking = True
                 print("Thinking...")
                 return_queue = Queue()  # This is used to pass data between threads.
-                move_finder_process = Process(target=chessAI.find_best_move, args=(gs, valid_moves, return_queue))
+                # The search gets a clone so the size of what is sent to the process doesn't grow with the game.
+                move_finder_process = Process(target=chessAI.find_best_move,
+                                              args=(gs.clone(), valid_moves, return_queue, analysis_cache))
                 move_finder_process.start()  # call find_best_move(gs, valid_moves, return_queue)
 
-            if not move_finder_process.is_alive():
-                print("Done thinking.")
-                ai_move = return_queue.get()
+            try:
+                ai_move, search_stats = return_queue.get_nowait()  # Don't wait for the AI, keep drawing.
+            except queue.Empty:
+                pass
+            else:
+                move_finder_process.join()
+                print("Done thinking.", search_stats.summary())
+                if SEARCH_STATS_FILE:
+                    search_stats.write_jsonl(SEARCH_STATS_FILE)
                 # In case the algorithm can't find the best move, choose a random move.
                 if ai_move == None:
                     ai_move = chessAI.find_random_move(valid_moves)
@@ -137,108 +196,230 @@ def main():
 
         # Only generate new list of valid moves if a valid move was made.
         if move_made:
+            # Start generating the moves of the new position while the move is being animated.
+            move_generator.request(gs)
+            valid_moves = []
+            waiting_for_moves = True
             if animate:
-                animate_move(gs.move_log[-1], screen, gs.board, clock)   # Animate the last move in the move log.
-            valid_moves = gs.get_valid_moves()
+                animate_move(gs.move_log[-1], screen, gs, clock, renderer)   # Animate the last move in the move log.
             move_made = False  # Reset the flag.
             animate = False
             move_undone = False
 
-        draw_game_state(screen, gs, valid_moves, sq_selected)
-
-        if gs.checkmate:
+        text = None
+        if waiting_for_moves:
+            pass   # The checkmate and stalemate flags are only known once the moves are generated.
+        elif gs.checkmate:
             game_over = True
             if gs.white_to_move:
-                draw_text(screen, 'Black wins by checkmate!')
+                text = 'Black wins by checkmate!'
             else:
-                draw_text(screen, 'White wins by checkmate!')
+                text = 'White wins by checkmate!'
         elif gs.stalemate:
             game_over = True
-            draw_text(screen, 'Stalemate!')
+            text = 'Stalemate!'
 
+        dirty_rects = renderer.draw(screen, gs, valid_moves, sq_selected, text, pending_promotion)
         clock.tick(MAX_FPS)
-        pg.display.flip()
+        pg.display.update(dirty_rects)   # Only push the squares that changed to the display.
+
+    if analysis_cache is not None:
+        analysis_cache.save()
+        analysis_cache.close()
+
+
+class MoveGenerator():
+    """Generates the valid moves of a position on a background thread so the window keeps responding."""
+
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.generation = 0   # Identifies the latest request, older results are thrown away.
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def request(self, gs):
+        """Start generating the valid moves of gs. The thread works on a clone so gs can still be drawn."""
+        self.generation += 1
+        self.requests.put((self.generation, gs.clone()))
+
+    def run(self):
+        while True:
+            generation, gs = self.requests.get()
+            if generation != self.generation:
+                continue   # A newer position was requested in the meantime.
+            moves = gs.get_valid_moves()
+            self.results.put((generation, (moves, gs.checkmate, gs.stalemate)))
+
+    def poll(self):
+        """Returns (valid moves, checkmate, stalemate) of the latest request, or None if it isn't ready yet."""
+        latest = None
+        while True:
+            try:
+                generation, result = self.results.get_nowait()
+            except queue.Empty:
+                return latest
+            if generation == self.generation:
+                latest = result
+
+
+class Renderer():
+    """Keeps track of what was drawn on every square so that only the squares that changed are redrawn."""
+
+    def __init__(self):
+        self.drawn = []
+        self.text = None
+        self.text_rect = None
+        self.invalidate()
 
+    def invalidate(self):
+        """Forget what is on the screen so that the next draw redraws everything."""
+        self.drawn = [[None] * DIMENSION for _ in range(DIMENSION)]
 
-def highlight_squares(screen, gs, valid_moves, sq_selected):
-    """Highlight square selected and the valid moves for the piece."""
+    def draw(self, screen, gs, valid_moves, sq_selected, text=None, promotion=None):
+        """Draws the squares that changed since the last call and returns their rects.
+        If a promotion move is given, the pieces the pawn can be promoted to are drawn over the board."""
+        highlights = get_highlights(gs, valid_moves, sq_selected)
+        overlay = {}
+        if promotion is not None:
+            overlay = {square: (piece, 'green') for square, piece in get_promotion_choices(promotion)}
+        text_changed = text != self.text
+        dirty_rects = []
+        for row in range(DIMENSION):
+            for col in range(DIMENSION):
+                state = overlay.get((row, col)) or (gs.board[row][col], highlights.get((row, col)))
+                rect = square_rect(row, col)
+                # The squares under a text that is removed or replaced have to be redrawn as well.
+                covered = text_changed and self.text_rect is not None and rect.colliderect(self.text_rect)
+                if state != self.drawn[row][col] or covered:
+                    draw_square(screen, row, col, *state)
+                    self.drawn[row][col] = state
+                    dirty_rects.append(rect)
+        self.text_rect = None
+        if text is not None:
+            self.text_rect = get_text_rect(text)
+            # Redraw the text if it's new or if one of the squares under it was redrawn.
+            if text_changed or self.text_rect.collidelist(dirty_rects) != -1:
+                draw_text(screen, text)
+                dirty_rects.append(self.text_rect)
+        self.text = text
+        return dirty_rects
+
+
+def square_rect(row, col):
+    return pg.Rect(col*SQ_SIZE, row*SQ_SIZE, SQ_SIZE, SQ_SIZE)
+
+
+def get_highlights(gs, valid_moves, sq_selected):
+    """Map the square selected and the squares the selected piece can move to onto their highlight color."""
+    highlights = {}
     if sq_selected != ():   # Making sure we selected a square.
         row, col = sq_selected
         # Making sure we selected a piece that can be moved.
         if gs.board[row][col][0] == ('w' if gs.white_to_move else 'b'):
-            # Highlight the selected square.
-            surface = pg.Surface((SQ_SIZE, SQ_SIZE))
-            surface.set_alpha(100)   # Tranperancy value.
-            surface.fill(pg.Color('blue'))
-            screen.blit(surface, (col*SQ_SIZE, row*SQ_SIZE))
+            highlights[(row, col)] = 'blue'
             # Highlight moves from that square.
-            surface.fill(pg.Color('yellow'))
             for move in valid_moves:
                 if move.start_row == row and move.start_col == col:
-                    screen.blit(surface, (SQ_SIZE*move.end_col, SQ_SIZE*move.end_row))
+                    highlights[(move.end_row, move.end_col)] = 'yellow'
+    return highlights
 
 
-def draw_game_state(screen, gs, valid_moves, sq_selected):
-    """Draws the squares on the board and puts the pieces on that board."""
-    draw_board(screen)
-    # Highlight.
-    highlight_squares(screen, gs, valid_moves, sq_selected)
-    draw_pieces(screen, gs.board)
+def get_promotion_choices(move):
+    """The squares the promotion choices are shown on, starting at the promotion square, with their pieces."""
+    direction = 1 if move.end_row == 0 else -1   # Towards the middle of the board.
+    return [((move.end_row + i*direction, move.end_col), move.piece_moved[0] + piece) for i, piece in enumerate("QRBN")]
 
 
-def draw_board(screen):
-    """Draw the squares on the board. The top left square is always white."""
-    global colors
-    colors = [pg.Color("white"), pg.Color("grey")]
-    # For all white squares the sum of the row number and the column number is always even. (0,0) (0,2)
-    # Whereas for dark squares the sum is always odd. (0,1) (0,3)
-    for row in range(DIMENSION):
-        for col in range(DIMENSION):
-            color = colors[((row+col) % 2)]
-            pg.draw.rect(screen, color, pg.Rect(col*SQ_SIZE, row*SQ_SIZE, SQ_SIZE, SQ_SIZE))
+def get_board_surface():
+    """The empty board is only drawn once. The top left square is always white."""
+    global BOARD_SURFACE
+    if BOARD_SURFACE is None:
+        BOARD_SURFACE = pg.Surface((WIDTH, HEIGHT))
+        # For all white squares the sum of the row number and the column number is always even. (0,0) (0,2)
+        # Whereas for dark squares the sum is always odd. (0,1) (0,3)
+        for row in range(DIMENSION):
+            for col in range(DIMENSION):
+                pg.draw.rect(BOARD_SURFACE, COLORS[(row+col) % 2], square_rect(row, col))
+    return BOARD_SURFACE
 
 
-def draw_pieces(screen, board):
-    """Draws the pieces on the board using the current game state board."""
-    for row in range(DIMENSION):
-        for col in range(DIMENSION):
-            piece = board[row][col]
-            if piece != "--":
-                screen.blit(IMAGES[piece], pg.Rect(col*SQ_SIZE, row*SQ_SIZE, SQ_SIZE, SQ_SIZE))
+def get_highlight_surface(color):
+    """A transparent square of the given color, created once per color."""
+    if color not in HIGHLIGHTS:
+        surface = pg.Surface((SQ_SIZE, SQ_SIZE))
+        surface.set_alpha(100)   # Tranperancy value.
+        surface.fill(pg.Color(color))
+        HIGHLIGHTS[color] = surface
+    return HIGHLIGHTS[color]
 
 
-def animate_move(move, screen, board, clock):
-    global colors
+def draw_square(screen, row, col, piece, highlight=None):
+    """Draws a single square: the board underneath, its highlight and the piece on it."""
+    rect = square_rect(row, col)
+    screen.blit(get_board_surface(), rect, rect)
+    if highlight is not None:
+        screen.blit(get_highlight_surface(highlight), rect)
+    if piece != "--":
+        screen.blit(get_image(piece), rect)
+
+
+def animate_move(move, screen, gs, clock, renderer):
+    """Slide the moved piece to its end square. Only the squares the piece passes over are redrawn."""
+    dirty_rects = renderer.draw(screen, gs, [], ())   # The board after the move, with the highlights removed.
+    # Erase the piece moved from its ending square and draw the captured piece back onto it.
+    draw_square(screen, move.end_row, move.end_col, move.piece_captured)
+    renderer.drawn[move.end_row][move.end_col] = None   # Will be redrawn once the animation is over.
+    dirty_rects.append(square_rect(move.end_row, move.end_col))
+    background = screen.copy()
     delta_row = move.end_row - move.start_row
     delta_col = move.end_col - move.start_col
     frames_per_square = 3   # Frames to move one square.
     frame_count = (abs(delta_row) + abs(delta_col)) * frames_per_square
+    piece_rect = square_rect(move.start_row, move.start_col)
     for frame in range(frame_count + 1):
         row, col = (move.start_row + delta_row*frame/frame_count, move.start_col + delta_col*frame/frame_count)
-        draw_board(screen)
-        draw_pieces(screen, board)
-        # Erase the piece moved from its ending square
-        color = colors[(move.end_row + move.end_col) % 2]
-        end_square = pg.Rect(move.end_col*SQ_SIZE, move.end_row*SQ_SIZE, SQ_SIZE, SQ_SIZE)
-        pg.draw.rect(screen, color, end_square)
-        # Draw captured piece onto rectangle.
-        if move.piece_captured != '--':
-            screen.blit(IMAGES[move.piece_captured], end_square)
+        # Restore what was under the piece in the previous frame.
+        screen.blit(background, piece_rect, piece_rect)
+        dirty_rects.append(piece_rect)
         # Draw the moving piece.
-        screen.blit(IMAGES[move.piece_moved], pg.Rect(col*SQ_SIZE, row*SQ_SIZE, SQ_SIZE, SQ_SIZE))
-        pg.display.flip()
+        piece_rect = pg.Rect(col*SQ_SIZE, row*SQ_SIZE, SQ_SIZE, SQ_SIZE)
+        screen.blit(get_image(move.piece_moved), piece_rect)
+        dirty_rects.append(piece_rect)
+        pg.display.update(dirty_rects)
+        dirty_rects = []
         clock.tick(60)
 
 
-def draw_text(screen, text):
-    font = pg.font.SysFont("Helvitca", 32, True, False)
-    text_object = font.render(text, 0, pg.Color('red'))
+def get_font():
+    global FONT
+    if FONT is None:
+        FONT = pg.font.SysFont("Helvitca", 32, True, False)
+    return FONT
+
+
+def get_text_surfaces(text):
+    """The text and its shadow are only rendered once."""
+    if text not in TEXTS:
+        font = get_font()
+        TEXTS[text] = (font.render(text, 0, pg.Color('red')), font.render(text, 0, pg.Color('Black')))
+    return TEXTS[text]
+
+
+def get_text_rect(text):
+    """The area covered by the text and its shadow."""
+    text_object = get_text_surfaces(text)[0]
     text_location = pg.Rect(0, 0, WIDTH, HEIGHT).move(
         WIDTH/2 - text_object.get_width()/2, HEIGHT/2 - text_object.get_height()/2)
+    text_rect = pg.Rect(text_location.topleft, text_object.get_size())
+    return text_rect.union(text_rect.move(2, 2))
+
+
+def draw_text(screen, text):
+    text_object, shadow_object = get_text_surfaces(text)
+    text_location = get_text_rect(text).topleft
     screen.blit(text_object, text_location)
-    text_object = font.render(text, 0, pg.Color('Black'))
-    screen.blit(text_object, text_location.move(2, 2))
+    screen.blit(shadow_object, (text_location[0] + 2, text_location[1] + 2))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
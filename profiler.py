@@ -0,0 +1,139 @@
+"""
+This file is responsible for profiling the hot paths of the engine.
+The hooks are opt-in: nothing is wrapped until a Profiler is enabled, so the engine runs at full speed otherwise.
+Usage: python profiler.py [depth] [collapsed stack file]
+"""
+import inspect
+import sys
+import time
+from collections import defaultdict
+from functools import wraps
+from queue import Queue
+
+import chess
+import chessAI
+
+# The (owner, attribute name) of every function we want to measure.
+HOT_PATHS = [(chess.GameState, "get_valid_moves"), (chess.GameState, "get_possible_moves"),
+             (chess.GameState, "square_under_attack"), (chess.GameState, "make_move"),
+             (chess.GameState, "undo_move"), (chessAI, "score_board")]
+# The search itself, so the stacks show where in the tree the time of the hot paths goes.
+SEARCH_PATHS = [(chessAI, "find_move_nega_max_alpha_beta"), (chess.GameState, "get_staged_moves"),
+                (chess.GameState, "is_legal"), (chess.GameState, "in_check")]
+
+
+class Profiler():
+    """Records call counts, cumulative and self time of the hot paths while enabled.
+    Can be used as a context manager: with Profiler() as profiler: ..."""
+
+    def __init__(self, hot_paths=HOT_PATHS + SEARCH_PATHS, extra_paths=()):
+        self.hot_paths = list(hot_paths) + list(extra_paths)
+        self.calls = defaultdict(int)
+        self.total_time = defaultdict(float)
+        self.self_time = defaultdict(float)
+        self.stacks = defaultdict(float)  # Self time of every call stack, keyed by the tuple of the function names.
+        self.stack = []  # The names of the functions currently being executed.
+        self.child_time = []  # Time spent in the children of each function in the stack.
+        self.originals = []
+
+    def enable(self):
+        """Replace every hot path with a timed wrapper."""
+        for owner, attr in self.hot_paths:
+            func = getattr(owner, attr)
+            self.originals.append((owner, attr, func))
+            setattr(owner, attr, self.wrap(f"{owner.__name__}.{attr}", func))
+        return self
+
+    def disable(self):
+        """Put the original functions back."""
+        for owner, attr, func in reversed(self.originals):
+            setattr(owner, attr, func)
+        self.originals = []
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *exc):
+        self.disable()
+
+    def wrap(self, name, func):
+        stack = self.stack
+        child_time = self.child_time
+
+        def timed(call, *args, count=True):
+            stack.append(name)
+            child_time.append(0.0)
+            start = time.perf_counter()
+            try:
+                return call(*args)
+            finally:
+                elapsed = time.perf_counter() - start
+                self_elapsed = elapsed - child_time.pop()
+                self.stacks[tuple(stack)] += self_elapsed
+                stack.pop()
+                if child_time:
+                    child_time[-1] += elapsed  # Let the caller know how long we took.
+                if name not in stack:  # Don't count the time of recursive calls twice.
+                    self.total_time[name] += elapsed
+                if count:
+                    self.calls[name] += 1
+                self.self_time[name] += self_elapsed
+
+        if inspect.isgeneratorfunction(func):
+            # A generator's body runs a bit at every resume, so every resume is timed. Only the first one is counted
+            # as a call.
+            @wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                generator = func(*args, **kwargs)
+                first = True
+                while True:
+                    try:
+                        value = timed(next, generator, count=first)
+                    except StopIteration:
+                        return
+                    first = False
+                    yield value
+            return generator_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return timed(lambda: func(*args, **kwargs))
+        return wrapper
+
+    def reset(self):
+        self.calls.clear()
+        self.total_time.clear()
+        self.self_time.clear()
+        self.stacks.clear()
+
+    def report(self):
+        """A table of the functions sorted by their self time."""
+        lines = [f"{'function':<32}{'calls':>10}{'total (s)':>12}{'self (s)':>12}{'per call (us)':>15}"]
+        for name in sorted(self.calls, key=lambda name: self.self_time[name], reverse=True):
+            per_call = self.total_time[name] / self.calls[name] * 1e6
+            lines.append(f"{name:<32}{self.calls[name]:>10}{self.total_time[name]:>12.4f}"
+                         f"{self.self_time[name]:>12.4f}{per_call:>15.1f}")
+        return "\n".join(lines)
+
+    def write_collapsed(self, path):
+        """Write the stacks in the collapsed format used by flamegraph.pl and speedscope.
+        Each line is the stack joined by ';' followed by its self time in microseconds."""
+        with open(path, "w") as f:
+            for stack, elapsed in sorted(self.stacks.items()):
+                f.write(f"{';'.join(stack)} {round(elapsed * 1e6)}\n")
+
+
+def main():
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else chessAI.DEPTH
+    collapsed_file = sys.argv[2] if len(sys.argv) > 2 else "profile.collapsed"
+    chessAI.DEPTH = depth
+    gs = chess.GameState()
+    with Profiler() as profiler:
+        chessAI.find_best_move(gs, gs.get_valid_moves(), Queue())
+    print(profiler.report())
+    profiler.write_collapsed(collapsed_file)
+    print(f"Collapsed stacks written to {collapsed_file}")
+
+
+if __name__ == "__main__":
+    main()
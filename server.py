@@ -0,0 +1,445 @@
+"""
+This file is responsible for serving position analysis to many clients at once over a local HTTP/JSON API.
+The searches run on a pool of --workers long-lived processes, which take the queued jobs one at a time.
+Usage: python server.py [--port PORT] [--workers N] [--queue-limit N] [--cache PATH]
+
+POST   /analyse    {"fen": ..., "moves": ["e2e4", ...], "depth": 3, "deadline": 5.0, "wait": false}
+                   202 {"id": ...}, or the finished job if "wait" is true. 503 when the queue is full.
+GET    /jobs/<id>  The job's status and, once it's done, its result.
+DELETE /jobs/<id>  Cancel a queued or running job.
+GET    /metrics    Queue depth, running jobs, counters and latency percentiles.
+"""
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import chess
+import chessAI
+from analysis_cache import AnalysisCache
+
+HOST = "127.0.0.1"   # Only ever listen on the loopback interface.
+PORT = 8765
+WORKERS = 4   # Search processes, and so searches running at the same time.
+QUEUE_LIMIT = 64   # Jobs waiting for a worker before new requests are turned away.
+MAX_DEPTH = 6
+DEFAULT_DEPTH = 3
+DEFAULT_DEADLINE = 30.0   # Seconds from submission.
+FINISHED_JOBS_KEPT = 1000
+LATENCIES_KEPT = 1000
+POLL_INTERVAL = 0.005   # How often the scheduler checks on the running searches.
+# The workers are never forked from the threaded server, a fork could copy a lock held by one of its threads.
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+CONTEXT = multiprocessing.get_context(START_METHOD)
+
+
+class RequestError(Exception):
+    """A request that can't be served, reported to the client with the given HTTP status."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_position(fen, moves):
+    """Set up the position given by a FEN string (the starting position if None) and a list of moves in coordinate
+    notation (e2e4, e7e8q)."""
+    if fen is not None and not isinstance(fen, str):
+        raise RequestError("fen must be a string")
+    try:
+        gs = chess.GameState(fen) if fen else chess.GameState()
+    except ValueError as e:
+        raise RequestError(f"invalid fen: {e}")
+    for notation in moves:
+        # The optional fifth letter is the piece a pawn is promoted to.
+        if not isinstance(notation, str) or len(notation) not in (4, 5) or notation[4:] not in ("", "q", "r", "b", "n"):
+            raise RequestError(f"invalid move: {notation}")
+        for move in gs.get_valid_moves():
+            if move.get_chess_notation() == notation[:4]:
+                gs.make_move(move, notation[4:].upper() or 'Q')
+                break
+        else:
+            raise RequestError(f"illegal move: {notation}")
+    return gs
+
+
+def search(job_id, snapshot, depth, results, analysis_cache=None):
+    """Searches the position one ply deeper at a time and puts (job id, result) of every finished depth on the
+    results queue, so that a search stopped by its deadline still has an answer."""
+    gs = chess.GameState.from_bytes(snapshot)
+    valid_moves = gs.get_valid_moves()
+    if not valid_moves:
+        results.put((job_id, {"depth": 0, "move": None, "checkmate": gs.checkmate, "stalemate": gs.stalemate}))
+        return
+    for iteration_depth in range(1, depth + 1):
+        chessAI.DEPTH = iteration_depth
+        return_queue = queue.Queue()
+        chessAI.find_best_move(gs, list(valid_moves), return_queue, analysis_cache)
+        move, stats = return_queue.get()
+        results.put((job_id, {"depth": iteration_depth, "move": move.get_chess_notation() if move else None,
+                              "stats": stats.to_dict()}))
+
+
+def work(jobs, results, cache_path=None):
+    """Runs in a worker process. Searches the jobs it's given, one at a time, for as long as the server is running.
+    A search that raises an exception is reported as {"error": ...} and the worker carries on with the next job."""
+    analysis_cache = AnalysisCache(cache_path) if cache_path else None
+    while multiprocessing.parent_process().is_alive():
+        try:
+            job_id, snapshot, depth = jobs.get(timeout=1)
+        except queue.Empty:
+            continue   # Check that the server is still there.
+        try:
+            search(job_id, snapshot, depth, results, analysis_cache)
+        except Exception as e:
+            traceback.print_exc()
+            results.put((job_id, {"error": f"{e.__class__.__name__}: {e}"}))
+    if analysis_cache is not None:
+        analysis_cache.close()
+
+
+class Worker():
+    """A long-lived search process and the queues it talks through. It's only replaced when the job it runs has to
+    be stopped, or when it dies."""
+
+    def __init__(self, cache_path=None):
+        self.jobs = CONTEXT.Queue()
+        self.results = CONTEXT.Queue()
+        self.process = CONTEXT.Process(target=work, args=(self.jobs, self.results, cache_path), daemon=True)
+        self.started = False
+        self.job = None   # The job it's searching.
+
+    def start(self):
+        self.process.start()
+        self.started = True
+
+    def kill(self):
+        if self.started:
+            self.process.terminate()
+            self.process.join()
+
+
+class Job():
+    def __init__(self, job_id, gs, depth, deadline):
+        self.id = job_id
+        self.snapshot = gs.to_bytes()
+        self.fen = gs.get_fen()
+        self.depth = depth
+        self.submitted = time.monotonic()
+        self.deadline = self.submitted + deadline
+        self.started = None
+        self.finished = None
+        self.status = "queued"   # queued, running, done, cancelled, expired or failed.
+        self.result = None   # The result of the deepest finished search.
+        self.error = None   # Why the search failed.
+        self.worker = None
+
+    def to_dict(self):
+        job = {"id": self.id, "status": self.status, "fen": self.fen, "depth": self.depth, "result": self.result}
+        if self.started is not None:
+            job["queue_time"] = round(self.started - self.submitted, 6)
+        if self.finished is not None:
+            job["latency"] = round(self.finished - self.submitted, 6)
+        if self.error is not None:
+            job["error"] = self.error
+        return job
+
+
+class Scheduler():
+    """Keeps the queue of jobs and runs them on a fixed pool of search processes.
+    A scheduler thread hands the queued jobs to idle workers, collects the results and stops the jobs that are past
+    their deadline. Stopping a job kills its worker, which is replaced by a new one."""
+
+    def __init__(self, workers=WORKERS, queue_limit=QUEUE_LIMIT, cache_path=None):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.cache_path = cache_path
+        self.lock = threading.Condition()   # Notified every time a job finishes.
+        self.ids = itertools.count(1)
+        self.queued = deque()
+        self.running = []
+        self.jobs = OrderedDict()   # Every job that is queued, running or recently finished, by id.
+        self.counters = {"submitted": 0, "rejected": 0, "done": 0, "cancelled": 0, "expired": 0,
+                         "failed": 0}
+        self.latencies = deque(maxlen=LATENCIES_KEPT)
+        self.queue_times = deque(maxlen=LATENCIES_KEPT)
+        self.stopped = False
+        if START_METHOD == "forkserver":
+            # Every worker is forked from a process that has already imported the engine.
+            CONTEXT.set_forkserver_preload(["chess", "chessAI", "analysis_cache"])
+        self.pool = [Worker(cache_path) for _ in range(workers)]
+        for worker in self.pool:
+            worker.start()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, gs, depth, deadline):
+        with self.lock:
+            if len(self.queued) >= self.queue_limit:
+                self.counters["rejected"] += 1
+                raise RequestError("too many queued jobs, try again later", status=503)
+            job = Job(next(self.ids), gs, depth, deadline)
+            self.jobs[job.id] = job
+            self.queued.append(job)
+            self.counters["submitted"] += 1
+            return job
+
+    def get(self, job_id):
+        with self.lock:
+            if job_id not in self.jobs:
+                raise RequestError(f"unknown job: {job_id}", status=404)
+            return self.jobs[job_id]
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.get(job_id)
+            if job.status == "queued":
+                self.queued.remove(job)
+                self.finish(job, "cancelled")
+            elif job.status == "running":
+                self.stop(job, "cancelled")
+            return job
+
+    def wait(self, job, timeout=None):
+        """Block until the job is finished."""
+        with self.lock:
+            self.lock.wait_for(lambda: job.finished is not None, timeout)
+
+    def start(self, job, worker):
+        job.status = "running"
+        job.started = time.monotonic()
+        self.queue_times.append(job.started - job.submitted)
+        job.worker = worker
+        worker.job = job
+        worker.jobs.put((job.id, job.snapshot, job.depth))
+        self.running.append(job)
+
+    def replace(self, worker):
+        """Kill a worker and put a new one in its place. The new worker is started by the scheduler thread, outside
+        the lock, because starting a process takes a while."""
+        worker.kill()
+        self.pool[self.pool.index(worker)] = Worker(self.cache_path)
+
+    def stop(self, job, status):
+        """Kill the worker of a running job. The deepest result it reported is kept."""
+        self.collect(job)
+        self.replace(job.worker)
+        self.running.remove(job)
+        self.finish(job, status)
+
+    def collect(self, job):
+        """Pick up the results the job's search has reported so far."""
+        while True:
+            try:
+                job_id, result = job.worker.results.get_nowait()
+            except queue.Empty:
+                return
+            if job_id != job.id:
+                continue
+            if "error" in result:
+                job.error = result["error"]
+            else:
+                job.result = result
+
+    def finish(self, job, status):
+        job.status = status
+        job.finished = time.monotonic()
+        if job.worker is not None:
+            job.worker.job = None
+            job.worker = None
+        self.counters[status] += 1
+        if status == "done":
+            self.latencies.append(job.finished - job.submitted)
+        # Forget the oldest finished jobs.
+        while len(self.jobs) > FINISHED_JOBS_KEPT:
+            oldest = next(iter(self.jobs.values()))
+            if oldest.finished is None:
+                break
+            self.jobs.popitem(last=False)
+        self.lock.notify_all()
+
+    def run(self):
+        while not self.stopped:
+            with self.lock:
+                now = time.monotonic()
+                for job in list(self.running):
+                    # Checked before collecting, so the results of a process that just exited are never missed.
+                    alive = job.worker.process.is_alive()
+                    self.collect(job)
+                    if job.result is not None and (job.result["depth"] == job.depth or job.result["move"] is None):
+                        self.running.remove(job)
+                        self.finish(job, "done")
+                    elif job.error is not None:
+                        # The search raised an exception, its worker is still fine.
+                        self.running.remove(job)
+                        self.finish(job, "failed")
+                    elif not alive:
+                        # The worker crashed or was killed before the final depth.
+                        job.error = f"the search process exited with code {job.worker.process.exitcode}"
+                        self.stop(job, "failed")
+                    elif now > job.deadline:
+                        # Out of time, answer with the deepest search that finished, if any.
+                        self.stop(job, "done" if job.result is not None else "expired")
+                # Jobs that ran out of time while waiting in the queue are never started.
+                for job in [job for job in self.queued if now > job.deadline]:
+                    self.queued.remove(job)
+                    self.finish(job, "expired")
+                for worker in self.pool:
+                    if worker.started and worker.job is None and not worker.process.is_alive():
+                        self.replace(worker)   # An idle worker died.
+                idle = [worker for worker in self.pool if worker.started and worker.job is None]
+                while self.queued and idle:
+                    self.start(self.queued.popleft(), idle.pop())
+                starting = [worker for worker in self.pool if not worker.started]
+            for worker in starting:
+                worker.start()
+            time.sleep(POLL_INTERVAL)
+
+    def shutdown(self):
+        self.stopped = True
+        self.thread.join()
+        with self.lock:
+            for job in list(self.running):
+                self.collect(job)
+                self.running.remove(job)
+                self.finish(job, "cancelled")
+            for worker in self.pool:
+                worker.kill()
+
+    def metrics(self):
+        with self.lock:
+            return {"queue_depth": len(self.queued), "running": len(self.running), "workers": self.workers,
+                    "queue_limit": self.queue_limit, **self.counters,
+                    "latency": percentiles(self.latencies), "queue_time": percentiles(self.queue_times)}
+
+
+def percentiles(values):
+    """The 50th, 95th and 99th percentiles (in seconds) of the given values."""
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "count": 0}
+    values = sorted(values)
+
+    def pick(p):
+        return round(values[min(len(values) - 1, int(p * len(values)))], 6)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "count": len(values)}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    scheduler = None   # Set by serve().
+
+    def log_message(self, format, *args):
+        pass   # One line per request would drown the load tests.
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 503:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, handler):
+        try:
+            self.send_json(*handler())
+        except RequestError as e:
+            self.send_json(e.status, {"error": str(e)})
+        except Exception as e:
+            # A bug, not a bad request, but the client still gets an answer it can parse.
+            self.send_json(500, {"error": f"internal error: {e.__class__.__name__}"})
+
+    def job_id(self):
+        try:
+            return int(self.path[len("/jobs/"):])
+        except ValueError:
+            raise RequestError(f"unknown job: {self.path[len('/jobs/'):]}", status=404)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.handle_request(lambda: (200, self.scheduler.metrics()))
+        elif self.path == "/health":
+            self.handle_request(lambda: (200, {"status": "ok"}))
+        elif self.path.startswith("/jobs/"):
+            self.handle_request(lambda: (200, self.scheduler.get(self.job_id()).to_dict()))
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_DELETE(self):
+        if self.path.startswith("/jobs/"):
+            self.handle_request(lambda: (200, self.scheduler.cancel(self.job_id()).to_dict()))
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path == "/analyse":
+            self.handle_request(self.analyse)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def analyse(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise RequestError("Content-Length must be a non-negative integer")
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            raise RequestError("the body must be a JSON object")
+        if not isinstance(request, dict):
+            raise RequestError("the body must be a JSON object")
+        depth = request.get("depth", DEFAULT_DEPTH)
+        deadline = request.get("deadline", DEFAULT_DEADLINE)
+        moves = request.get("moves", [])
+        # JSON's true and false are ints to Python, and NaN or Infinity would never expire.
+        if isinstance(depth, bool) or not isinstance(depth, int) or not 1 <= depth <= MAX_DEPTH:
+            raise RequestError(f"depth must be between 1 and {MAX_DEPTH}")
+        if (isinstance(deadline, bool) or not isinstance(deadline, (int, float)) or not math.isfinite(deadline)
+                or deadline <= 0):
+            raise RequestError("deadline must be a positive number of seconds")
+        if not isinstance(moves, list):
+            raise RequestError("moves must be a list")
+        gs = parse_position(request.get("fen"), moves)
+        job = self.scheduler.submit(gs, depth, deadline)
+        if request.get("wait"):
+            self.scheduler.wait(job)
+            return 200, job.to_dict()
+        return 202, {"id": job.id, "status": job.status}
+
+
+def serve(port=PORT, workers=WORKERS, queue_limit=QUEUE_LIMIT, cache_path=None):
+    scheduler = Scheduler(workers, queue_limit, cache_path)
+    RequestHandler.scheduler = scheduler
+    server = ThreadingHTTPServer((HOST, port), RequestHandler)
+    server.daemon_threads = True
+    print(f"Serving on http://{HOST}:{server.server_address[1]} with {workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scheduler.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve position analysis over a local HTTP/JSON API.")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="searches running at the same time")
+    parser.add_argument("--queue-limit", type=int, default=QUEUE_LIMIT, help="queued jobs before requests get a 503")
+    parser.add_argument("--cache", help="analysis cache file shared by the workers")
+    args = parser.parse_args()
+    serve(args.port, args.workers, args.queue_limit, args.cache)
+
+
+if __name__ == "__main__":
+    main()
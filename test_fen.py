@@ -0,0 +1,46 @@
+"""
+Regression checks for positions loaded from FEN strings, as the analysis server does.
+Run with: python -m pytest test_fen.py
+"""
+import pytest
+
+import chess
+import server
+
+
+def castle_moves(fen):
+    gs = chess.GameState(fen)
+    return [move.get_chess_notation() for move in gs.get_valid_moves() if move.is_castle_move]
+
+
+def test_castling_right_without_king_on_its_square_is_dropped():
+    # Used to crash the search with an IndexError, the king on g1 looked two squares to its right.
+    gs = chess.GameState("4k3/8/8/8/8/8/8/6K1 w K -")
+    assert not gs.current_castling_rights.wks
+    assert castle_moves("4k3/8/8/8/8/8/8/6K1 w K -") == []
+
+
+def test_castling_right_without_rook_is_dropped():
+    assert castle_moves("4k3/8/8/8/8/8/8/4K3 w KQ -") == []
+    assert castle_moves("4k3/8/8/8/8/8/8/7K w KQ -") == []
+    with pytest.raises(server.RequestError):
+        server.parse_position("4k3/8/8/8/8/8/8/4K3 w KQ -", ["e1c1"])
+
+
+def test_castling_rights_with_king_and_rooks_at_home_are_kept():
+    assert sorted(castle_moves("r3k2r/8/8/8/8/8/8/R3K2R w KQkq -")) == ["e1c1", "e1g1"]
+
+
+@pytest.mark.parametrize("castling", ["KX", "KK", "a"])
+def test_invalid_castling_letters_are_rejected(castling):
+    with pytest.raises(ValueError):
+        chess.GameState(f"r3k2r/8/8/8/8/8/8/R3K2R w {castling} -")
+
+
+@pytest.mark.parametrize("fen", ["P3k3/8/8/8/8/8/8/4K3 w - -", "4k3/8/8/8/8/8/8/p3K3 b - -"])
+def test_pawns_on_the_first_or_last_rank_are_rejected(fen):
+    with pytest.raises(ValueError):
+        chess.GameState(fen)
+    with pytest.raises(server.RequestError) as error:
+        server.parse_position(fen, ["e1e2"])
+    assert error.value.status == 400